@@ -1,25 +1,114 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import contextlib
+import errno
 import fcntl
+import hashlib
+import inspect
+import os
 import pathlib
-import shutil
+import platform
+import queue
+import re
+import shlex
+import stat
+import sys
+import threading
 import time
-import xml.etree.ElementTree as xml_element_tree
+import traceback
 
 import libvirt
 
+try:
+    from lxml import etree as xml_element_tree
+except ImportError:
+    import xml.etree.ElementTree as xml_element_tree
+
+try:
+    import pyuring
+except ImportError:
+    pyuring = None
+
 
 def main():
-    args = parse_args()
+    argv = sys.argv[1:]
+    if argv[:1] == ["serve"]:
+        failed = serve(parse_serve_args(argv[1:]))
+        if failed:
+            sys.exit(1)
+        return
+    args = parse_args(argv)
     with Connection.open(args.libvirt_uri) as conn:
-        dom = conn.domain_by_name(args.domain_name)
-        with lock_domain(args.domain_name, args.lock_dir):
-            with temporarily_shutdown_domain(dom, args.shutdown_timeout):
-                create_snapshot(dom, args.snapshot_name)
-                backup_disk_image(dom, args.backup_dst)
-            rotate_snapshots(dom, args.snapshot_name, args.snapshot_count)
+        run(args, conn)
+
+
+def serve(args):
+    failed = 0
+    with Connection.open(args.libvirt_uri) as conn:
+        for line in sys.stdin:
+            argv = shlex.split(line)
+            if not argv:
+                continue
+            try:
+                run(parse_job_args(argv), conn)
+            except SystemExit as e:
+                if e.code:
+                    failed += 1
+            except Exception:
+                traceback.print_exc()
+                failed += 1
+    return failed
+
+
+def run(args, conn):
+    dom = conn.domain_by_name(args.domain_name)
+    marker = args.lock_dir / f"{args.domain_name}.backup"
+    job = f"{args.snapshot_name}\n{args.backup_dst}\n"
+    with lock_domain(args.domain_name, args.lock_dir):
+        if has_recent_backup(marker, job, args.borrow_window):
+            return
+        if args.live and dom.state_code() == libvirt.VIR_DOMAIN_RUNNING:
+            backup_disk_image_live(
+                dom, args.backup_dst, args.backup_checksum, args.commit_timeout
+            )
+        elif args.boot_during_copy:
+            backup_disk_image_pipelined(
+                dom,
+                args.snapshot_name,
+                args.backup_dst,
+                args.backup_checksum,
+                args.shutdown_timeout,
+                args.commit_timeout,
+            )
+        else:
+            backup_disk_image_offline(
+                dom,
+                args.snapshot_name,
+                args.backup_dst,
+                args.backup_checksum,
+                args.shutdown_timeout,
+            )
+        rotate_snapshots(dom, args.snapshot_name, args.snapshot_count)
+        record_backup(marker, job)
+
+
+def has_recent_backup(marker, job, window):
+    if window == 0:
+        return False
+    try:
+        mtime = marker.stat().st_mtime
+        recorded = marker.read_text()
+    except FileNotFoundError:
+        return False
+    return recorded == job and time.time() - mtime < window
+
+
+def record_backup(marker, job):
+    tmp = marker.with_name(f"{marker.name}.tmp")
+    tmp.write_text(job)
+    os.replace(tmp, marker)
 
 
 def create_snapshot(dom, name):
@@ -27,19 +116,196 @@ def create_snapshot(dom, name):
     dom.create_snapshot(name, atomic=True)
 
 
-def backup_disk_image(dom, dst):
+def backup_disk_image_offline(dom, name, dst, checksum, shutdown_timeout):
+    with temporarily_shutdown_domain(dom, shutdown_timeout):
+        create_snapshot(dom, name)
+        backup_disk_image(dom, dst, checksum)
+
+
+def backup_disk_image(dom, dst, checksum):
     if dst is None:
         return
     src = dom.disk_image_path()
-    shutil.copy(src, dst)
+    copy_file(src, dst, checksum)
+
+
+def backup_disk_image_pipelined(
+    dom, name, dst, checksum, shutdown_timeout, commit_timeout
+):
+    with contextlib.ExitStack() as stack:
+        with temporarily_shutdown_domain(dom, shutdown_timeout):
+            create_snapshot(dom, name)
+            if dst is None:
+                return
+            src = stack.enter_context(temporarily_overlay_disk(dom, commit_timeout))
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            )
+            copy = executor.submit(copy_file, src, dst, checksum)
+        copy.result()
+
+
+def backup_disk_image_live(dom, dst, checksum, commit_timeout):
+    if dst is None:
+        return
+    with temporarily_overlay_disk(dom, commit_timeout) as src:
+        copy_file(src, dst, checksum)
+
+
+def copy_file(src, dst, checksum=False):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    checksum_file = f"{dst}.sha256"
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(checksum_file)
+    if checksum:
+        sha256 = hashlib.sha256()
+        copy_file_contents(src, dst, update=sha256.update)
+        write_checksum(checksum_file, sha256.hexdigest(), dst)
+    elif sys.platform != "linux":
+        with open(src, "rb") as fsrc, create_backup_file(src, dst) as fdst:
+            copy_stream(fsrc, fdst)
+    elif io_uring_supported():
+        # pyuring opens the files itself: pre-create dst only so that it gets
+        # the source mode, and go without the fadvise hints of the fd path.
+        create_backup_file(src, dst).close()
+        try:
+            pyuring.copy(
+                src,
+                dst,
+                mode="auto",
+                qd=IO_URING_QUEUE_DEPTH,
+                block_size=IO_URING_BLOCK_SIZE,
+                fsync=True,
+            )
+        except OSError:
+            copy_file_contents(src, dst)
+    else:
+        copy_file_contents(src, dst)
+
+
+def write_checksum(path, digest, dst):
+    with open(path, "w") as f:
+        f.write(f"{digest}  {os.path.basename(dst)}\n")
+        f.flush()
+        datasync(f.fileno())
+
+
+def create_backup_file(src, dst):
+    mode = stat.S_IMODE(os.stat(src).st_mode)
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.fchmod(fd, mode)
+    except OSError:
+        os.close(fd)
+        raise
+    return open(fd, "wb")
+
+
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def copy_stream(fsrc, fdst, update=None):
+    buf = memoryview(bytearray(COPY_BUFFER_SIZE))
+    while True:
+        n = fsrc.readinto(buf)
+        if not n:
+            break
+        if update is not None:
+            update(buf[:n])
+        fdst.write(buf[:n])
+
+
+def copy_file_contents(src, dst, update=None):
+    with open(src, "rb") as fsrc, create_backup_file(src, dst) as fdst:
+        (src_fd, dst_fd) = (fsrc.fileno(), fdst.fileno())
+        fadvise(src_fd, "POSIX_FADV_SEQUENTIAL")
+        size = os.fstat(src_fd).st_size
+        streamed = update is not None
+        if not streamed:
+            try:
+                copy_fd(src_fd, dst_fd, size)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                streamed = True
+        if streamed:
+            copy_stream(fsrc, fdst, update=update)
+            fdst.flush()
+        datasync(dst_fd)
+        fadvise(dst_fd, "POSIX_FADV_DONTNEED")
+        fadvise(src_fd, "POSIX_FADV_DONTNEED")
+
+
+def datasync(fd):
+    getattr(os, "fdatasync", os.fsync)(fd)
+
+
+def fadvise(fd, advice):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+IO_URING_MIN_KERNEL = (5, 15)
+IO_URING_QUEUE_DEPTH = 32
+IO_URING_BLOCK_SIZE = 1 << 20
+PYURING_COPY_PARAMS = {"mode", "qd", "block_size", "fsync"}
+
+
+def io_uring_supported():
+    if pyuring is None or not pyuring_copy_compatible():
+        return False
+    release = platform.release().split("-")[0].split(".")
+    try:
+        version = tuple(int(part) for part in release[:2])
+    except ValueError:
+        return False
+    return version >= IO_URING_MIN_KERNEL
+
+
+def pyuring_copy_compatible():
+    copy = getattr(pyuring, "copy", None)
+    if copy is None:
+        return False
+    try:
+        params = inspect.signature(copy).parameters
+    except (TypeError, ValueError):
+        return False
+    return PYURING_COPY_PARAMS <= params.keys()
+
+
+def copy_fd(src_fd, dst_fd, count):
+    copy = copy_file_range if hasattr(os, "copy_file_range") else sendfile
+    while count > 0:
+        try:
+            n = copy(src_fd, dst_fd, count)
+        except OSError as e:
+            if copy is sendfile or e.errno not in (errno.EXDEV, errno.ENOSYS):
+                raise
+            copy = sendfile
+            continue
+        if n == 0:
+            break
+        count -= n
+
+
+def copy_file_range(src_fd, dst_fd, count):
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+
+def sendfile(src_fd, dst_fd, count):
+    return os.sendfile(dst_fd, src_fd, None, count)
 
 
 def rotate_snapshots(dom, prefix, count):
     assert count > 0
-    snaps = [snap for snap in dom.list_snapshots() if snap.name().startswith(prefix)]
+    snaps = dom.list_snapshots(prefix=prefix)
     if len(snaps) <= count:
         return
-    snaps.sort(key=lambda snap: snap.timestamp())
+    snaps.sort(key=lambda snap: snap.timestamp(prefix))
     for snap in snaps[:-count]:
         snap.delete()
 
@@ -57,40 +323,94 @@ class Connection:
 
     def domain_by_name(self, name):
         dom = self._conn.lookupByName(name)
-        return Domain(dom=dom)
+        return Domain(dom=dom, conn=self._conn)
 
     @classmethod
     def open(cls, uri):
+        start_event_loop()
         conn = libvirt.open(uri)
         return Connection(conn=conn)
 
 
+DISK_XPATH = "./devices/disk[@type='file'][@device='disk']"
+
+if hasattr(xml_element_tree, "XPath"):
+    find_disks = xml_element_tree.XPath(DISK_XPATH)
+else:
+
+    def find_disks(desc):
+        return desc.iterfind(DISK_XPATH)
+
+
+def find_disk(desc):
+    disks = iter(find_disks(desc))
+    disk = next(disks, None)
+    assert disk is not None
+    if next(disks, None) is not None:
+        raise NotImplementedError
+    return disk
+
+
+def disk_image_path(disk):
+    src = disk.find("./source")
+    return src.attrib["file"]
+
+
 class Domain:
-    def __init__(self, dom):
+    def __init__(self, dom, conn):
         self._dom = dom
-        self._desc = xml_element_tree.fromstring(self._dom.XMLDesc())
+        self._conn = conn
+        self._desc = None
+        self._disk = None
 
-    def disk_image_path(self):
-        disks = self._desc.findall("./devices/disk[@type='file'][@device='disk']")
-        assert len(disks) > 0
-        if len(disks) > 1:
-            raise NotImplementedError
-        src = disks[0].find("./source")
-        return pathlib.Path(src.attrib["file"])
-
-    def is_up(self):
-        (state, _) = self._dom.state()
-        return state == libvirt.VIR_DOMAIN_RUNNING
+    def desc(self):
+        if self._desc is None:
+            self._desc = xml_element_tree.fromstring(self._dom.XMLDesc())
+        return self._desc
 
-    def is_down(self):
+    def disk(self):
+        if self._disk is None:
+            self._disk = find_disk(self.desc())
+        return self._disk
+
+    def disk_image_path(self):
+        return disk_image_path(self.disk())
+
+    def current_disk_image_paths(self):
+        return {
+            disk_image_path(find_disk(xml_element_tree.fromstring(desc)))
+            for desc in (
+                self._dom.XMLDesc(0),
+                self._dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE),
+            )
+        }
+
+    def disk_target(self):
+        target = self.disk().find("./target")
+        return target.attrib["dev"]
+
+    def other_disk_targets(self):
+        target = self.disk_target()
+        devs = [
+            disk.find("./target").attrib["dev"]
+            for disk in self.desc().iterfind("./devices/disk")
+        ]
+        return [dev for dev in devs if dev != target]
+
+    def state_code(self):
         (state, _) = self._dom.state()
-        return state == libvirt.VIR_DOMAIN_SHUTOFF
+        return state
 
     def down(self, timeout):
-        if not self.is_up():
+        if self.state_code() != libvirt.VIR_DOMAIN_RUNNING:
             return
-        self._dom.shutdown()
-        wait(lambda: self.is_down(), timeout=timeout)
+        with self.events(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE) as events:
+            self._dom.shutdown()
+            wait_for_event(
+                events,
+                lambda event, detail: event == libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                timeout=timeout,
+            )
 
     def up(self):
         self._dom.create()
@@ -104,22 +424,104 @@ class Domain:
             flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
         self._dom.snapshotCreateXML(desc, flags)
 
-    def list_snapshots(self):
-        return [Snapshot(snap=snap) for snap in self._dom.listAllSnapshots()]
+    def create_overlay(self, path):
+        others = "".join(
+            f'<disk name="{dev}" snapshot="no"/>' for dev in self.other_disk_targets()
+        )
+        desc = f"""<domainsnapshot>
+            <disks>
+                <disk name="{self.disk_target()}" snapshot="external">
+                    <source file="{path}"/>
+                </disk>
+                {others}
+            </disks>
+        </domainsnapshot>"""
+        flags = (
+            libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
+            | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+            | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA
+        )
+        self._dom.snapshotCreateXML(desc, flags)
+
+    def commit_overlay(self, timeout):
+        disk = self.disk_target()
+        with self.events(libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2) as events:
+            self._dom.blockCommit(
+                disk, None, None, 0, libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
+            )
+            try:
+                (_, _, status) = wait_for_event(
+                    events,
+                    lambda dev, job_type, status: dev == disk,
+                    timeout=timeout,
+                )
+            except TimeoutError:
+                self._dom.blockJobAbort(disk, 0)
+                raise
+        if status != libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+            raise RuntimeError(f"block commit of {disk} failed")
+        self._dom.blockJobAbort(disk, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+
+    @contextlib.contextmanager
+    def events(self, event_id):
+        received = queue.Queue()
+
+        def callback(conn, dom, *args):
+            received.put(args[:-1])
+
+        callback_id = self._conn.domainEventRegisterAny(
+            self._dom, event_id, callback, None
+        )
+        try:
+            yield received
+        finally:
+            self._conn.domainEventDeregisterAny(callback_id)
+
+    def list_snapshots(self, prefix=None):
+        return [
+            Snapshot(snap=snap)
+            for snap in self._dom.listAllSnapshots(0)
+            if prefix is None or snap.getName().startswith(prefix)
+        ]
+
+
+NAME_TIMESTAMP_RE = re.compile(r"[0-9]+")
 
 
 class Snapshot:
     def __init__(self, snap):
         self._snap = snap
-        self._desc = xml_element_tree.fromstring(self._snap.getXMLDesc())
+        self._desc = None
 
     def name(self):
         return self._snap.getName()
 
-    def timestamp(self):
-        elems = [elem for elem in self._desc if elem.tag == "creationTime"]
-        assert len(elems) == 1
-        return int(elems[0].text)
+    def desc(self):
+        if self._desc is None:
+            self._desc = xml_element_tree.fromstring(self._snap.getXMLDesc())
+        return self._desc
+
+    def timestamp(self, prefix=None):
+        if prefix is not None:
+            timestamp = self.timestamp_from_name(prefix)
+            if timestamp is not None:
+                return timestamp
+        return self.timestamp_from_desc()
+
+    def timestamp_from_name(self, prefix):
+        name = self.name()
+        head = f"{prefix}_"
+        if not name.startswith(head):
+            return None
+        suffix = name[len(head) :]
+        if not NAME_TIMESTAMP_RE.fullmatch(suffix):
+            return None
+        return int(suffix)
+
+    def timestamp_from_desc(self):
+        creation_time = self.desc().findtext("creationTime")
+        assert creation_time is not None
+        return int(creation_time)
 
     def delete(self):
         self._snap.delete()
@@ -146,33 +548,107 @@ def temporarily_shutdown_domain(dom, shutdown_timeout):
         dom.up()
 
 
-def wait(func, timeout):
-    t0 = time.monotonic()
-    while not func():
-        t1 = time.monotonic()
-        elapsed = t1 - t0
-        if elapsed >= timeout:
+@contextlib.contextmanager
+def temporarily_overlay_disk(dom, commit_timeout):
+    src = dom.disk_image_path()
+    overlay = f"{src}.overlay"
+    dom.create_overlay(overlay)
+    try:
+        yield src
+    finally:
+        restore_disk(dom, src, overlay, commit_timeout)
+
+
+def restore_disk(dom, src, overlay, commit_timeout):
+    if overlay in dom.current_disk_image_paths():
+        if dom.state_code() != libvirt.VIR_DOMAIN_RUNNING:
+            raise RuntimeError(f"domain is not running, disk left on {overlay}")
+        dom.commit_overlay(timeout=commit_timeout)
+    paths = dom.current_disk_image_paths()
+    if paths != {src}:
+        raise RuntimeError(f"disk not restored to {src}, still defined on {paths}")
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(overlay)
+
+
+def wait_for_event(events, match, timeout):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
             raise TimeoutError
-        time.sleep(1)
+        try:
+            args = events.get(timeout=remaining)
+        except queue.Empty:
+            raise TimeoutError
+        if match(*args):
+            return args
+
+
+event_loop_lock = threading.Lock()
+event_loop_thread = None
+
+
+def start_event_loop():
+    global event_loop_thread
+    with event_loop_lock:
+        if event_loop_thread is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        event_loop_thread = threading.Thread(target=run_event_loop, daemon=True)
+        event_loop_thread.start()
+
+
+def run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
 
 
 DEFAULT_LIBVIRT_URI = "qemu:///system"
 DEFAULT_SHUTDOWN_TIMEOUT = 30
+DEFAULT_COMMIT_TIMEOUT = 3600
 DEFAULT_LOCK_DIR = "/var/run/libvirt-snapshot-backup"
+DEFAULT_BORROW_WINDOW = 0
 
 
-def parse_args():
+def parse_args(argv):
     parser = argparse.ArgumentParser()
+    add_connection_arguments(parser)
+    add_job_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def parse_serve_args(argv):
+    parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} serve")
+    add_connection_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def parse_job_args(argv):
+    parser = argparse.ArgumentParser(prog="job")
+    add_job_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def add_connection_arguments(parser):
     parser.add_argument(
         "--libvirt-uri",
         type=non_empty_str,
         default=DEFAULT_LIBVIRT_URI,
     )
+
+
+def add_job_arguments(parser):
     parser.add_argument(
         "--shutdown-timeout",
         type=positive_int,
         default=DEFAULT_SHUTDOWN_TIMEOUT,
     )
+    parser.add_argument(
+        "--commit-timeout",
+        type=positive_int,
+        default=DEFAULT_COMMIT_TIMEOUT,
+    )
     parser.add_argument(
         "--domain-name",
         type=non_empty_str,
@@ -192,12 +668,32 @@ def parse_args():
         "--backup-dst",
         type=str,
     )
+    parser.add_argument(
+        "--backup-checksum",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help=(
+            "back up a running domain through a temporary external overlay "
+            "without pausing it; no internal snapshot is taken"
+        ),
+    )
+    parser.add_argument(
+        "--boot-during-copy",
+        action="store_true",
+    )
     parser.add_argument(
         "--lock-dir",
         type=pathlib.Path,
         default=DEFAULT_LOCK_DIR,
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--borrow-window",
+        type=non_negative_int,
+        default=DEFAULT_BORROW_WINDOW,
+    )
 
 
 def non_empty_str(v):
@@ -214,5 +710,12 @@ def positive_int(v):
     return i
 
 
+def non_negative_int(v):
+    i = int(v)
+    if i < 0:
+        raise ValueError("must not be negative")
+    return i
+
+
 if __name__ == "__main__":
     main()